@@ -8,14 +8,25 @@ for ingestion into Prometheus via the Pushgateway.
 
 import os
 import json
+import argparse
+import functools
 import logging
 import datetime
-from typing import Dict, List, Any, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from typing import Dict, List, Any, Callable, Optional
 from dataclasses import dataclass, asdict
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
 import time
 
+try:
+    import orjson  # Optional: much faster JSON serialization
+except ImportError:
+    orjson = None
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -27,7 +38,62 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@dataclass
+# Maximum number of queries accepted by a single GetMetricData request
+METRIC_DATA_QUERY_LIMIT = 500
+
+# Worker threads used to fetch budget performance history
+BUDGET_CONCURRENCY = 8
+
+# Local cache for slow-changing AWS metadata (metric and budget listings)
+METADATA_CACHE_FILE = 'data/aws_metadata_cache.json'
+_METADATA_CACHE_LOCK = threading.Lock()
+
+def _json_default(value: Any) -> str:
+    """Serialize datetimes in API payloads as ISO strings"""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+def clear_metadata_cache(filename: str = METADATA_CACHE_FILE):
+    """Delete the metadata cache so the next run refreshes it"""
+    try:
+        os.remove(filename)
+        logger.info(f"Cleared metadata cache {filename}")
+    except FileNotFoundError:
+        pass
+
+# Shared client config: pooled keep-alive connections and adaptive retries
+# to absorb API throttling
+_CONFIG = Config(
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    retries={'max_attempts': 10, 'mode': 'adaptive'}
+)
+
+# Cost Explorer metrics exported per service: (metric key, name, help text)
+_COST_METRICS = (
+    ('BlendedCost', 'aws_billing_blended_cost_usd', 'AWS blended cost by service in USD'),
+    ('UnblendedCost', 'aws_billing_unblended_cost_usd', 'AWS unblended cost by service in USD'),
+)
+
+def _iter_cost_rows(group_metrics: Dict[str, Any]):
+    """Yield (name, amount, unit, help_text) for each non-zero cost in a Cost Explorer group"""
+    for key, name, help_text in _COST_METRICS:
+        amount = float(group_metrics[key]['Amount'])
+        if amount > 0:
+            yield name, amount, group_metrics[key]['Unit'], help_text
+
+@functools.lru_cache(maxsize=None)
+def _get_session(region: str) -> boto3.session.Session:
+    """Return the process-wide boto3 session for a region"""
+    return boto3.session.Session(region_name=region)
+
+@functools.lru_cache(maxsize=None)
+def _get_client(service: str, region: str):
+    """Return a process-wide AWS client, created on first use"""
+    return _get_session(region).client(service, config=_CONFIG)
+
+@dataclass(slots=True, frozen=True)
 class BillingMetric:
     """Represents a billing metric for Prometheus"""
     name: str
@@ -42,11 +108,13 @@ class AWSBillingCollector:
     def __init__(self):
         self.region = os.getenv('AWS_REGION', 'us-east-1')
         self.account_id = os.getenv('AWS_ACCOUNT_ID', '')
+        self.metadata_cache_ttl = int(os.getenv('METADATA_CACHE_TTL', '21600'))
         
-        # Initialize AWS clients
+        # Initialize AWS clients (shared process-wide, see _get_client)
         try:
-            self.cloudwatch = boto3.client('cloudwatch', region_name=self.region)
-            self.ce_client = boto3.client('ce', region_name=self.region)  # Cost Explorer
+            self.cloudwatch = _get_client('cloudwatch', self.region)
+            self.ce_client = _get_client('ce', self.region)  # Cost Explorer
+            self.budgets_client = _get_client('budgets', self.region)
             logger.info(f"Initialized AWS clients for region: {self.region}")
         except NoCredentialsError:
             logger.error("AWS credentials not found. Please configure AWS credentials.")
@@ -55,6 +123,53 @@ class AWSBillingCollector:
             logger.error(f"Failed to initialize AWS clients: {str(e)}")
             raise
     
+    @staticmethod
+    def _read_metadata_cache() -> Dict[str, Any]:
+        """Read the metadata cache file, returning an empty cache if unusable"""
+        try:
+            with open(METADATA_CACHE_FILE, 'r') as f:
+                cache = json.load(f)
+            if isinstance(cache, dict):
+                return cache
+            logger.warning("Ignoring metadata cache that is not a JSON object")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable metadata cache: {str(e)}")
+        return {}
+    
+    def _cached_call(self, key: str, ttl_seconds: int, fn: Callable[[], Any]) -> Any:
+        """Return a cached API payload, calling fn() and caching its result on a miss
+        
+        Keys must include the account and region the payload belongs to.
+        """
+        with _METADATA_CACHE_LOCK:
+            entry = self._read_metadata_cache().get(key)
+        if isinstance(entry, dict) and 'payload' in entry and entry.get('expires_at', 0) > time.time():
+            logger.info(f"Using cached {key} (expires in {int(entry['expires_at'] - time.time())}s)")
+            return entry['payload']
+        
+        payload = fn()
+        
+        # Re-read under the lock so concurrent collectors don't drop each other's
+        # entries, and drop expired ones so keys for other accounts don't pile up
+        with _METADATA_CACHE_LOCK:
+            now = time.time()
+            cache = {
+                cache_key: cache_entry
+                for cache_key, cache_entry in self._read_metadata_cache().items()
+                if isinstance(cache_entry, dict) and cache_entry.get('expires_at', 0) > now
+            }
+            cache[key] = {'expires_at': now + ttl_seconds, 'payload': payload}
+            try:
+                os.makedirs(os.path.dirname(METADATA_CACHE_FILE), exist_ok=True)
+                with open(METADATA_CACHE_FILE, 'w') as f:
+                    json.dump(cache, f, indent=2, default=_json_default)
+            except Exception as e:
+                logger.warning(f"Failed to write metadata cache: {str(e)}")
+        
+        return payload
+    
     def get_current_costs(self, days_back: int = 1) -> List[BillingMetric]:
         """Get current costs from AWS Cost Explorer"""
         metrics = []
@@ -76,45 +191,27 @@ class AWSBillingCollector:
                 ]
             )
             
+            account_id = self.account_id
             current_time = datetime.datetime.now()
             
-            for result in response['ResultsByTime']:
-                date = result['TimePeriod']['Start']
-                
-                for group in result['Groups']:
-                    service = group['Keys'][0] if group['Keys'] else 'Unknown'
-                    
-                    # BlendedCost metric
-                    blended_cost = float(group['Metrics']['BlendedCost']['Amount'])
-                    if blended_cost > 0:
-                        metrics.append(BillingMetric(
-                            name='aws_billing_blended_cost_usd',
-                            value=blended_cost,
-                            labels={
-                                'service': service,
-                                'account_id': self.account_id,
-                                'date': date,
-                                'currency': group['Metrics']['BlendedCost']['Unit']
-                            },
-                            timestamp=current_time,
-                            help_text='AWS blended cost by service in USD'
-                        ))
-                    
-                    # UnblendedCost metric
-                    unblended_cost = float(group['Metrics']['UnblendedCost']['Amount'])
-                    if unblended_cost > 0:
-                        metrics.append(BillingMetric(
-                            name='aws_billing_unblended_cost_usd',
-                            value=unblended_cost,
-                            labels={
-                                'service': service,
-                                'account_id': self.account_id,
-                                'date': date,
-                                'currency': group['Metrics']['UnblendedCost']['Unit']
-                            },
-                            timestamp=current_time,
-                            help_text='AWS unblended cost by service in USD'
-                        ))
+            metrics = [
+                BillingMetric(
+                    name=name,
+                    value=value,
+                    labels={
+                        'service': service,
+                        'account_id': account_id,
+                        'date': result['TimePeriod']['Start'],
+                        'currency': unit
+                    },
+                    timestamp=current_time,
+                    help_text=help_text
+                )
+                for result in response['ResultsByTime']
+                for group in result['Groups']
+                for service in (group['Keys'][0] if group['Keys'] else 'Unknown',)
+                for name, value, unit, help_text in _iter_cost_rows(group['Metrics'])
+            ]
             
             logger.info(f"Collected {len(metrics)} cost metrics")
             
@@ -143,7 +240,9 @@ class AWSBillingCollector:
             
             current_time = datetime.datetime.now()
             
-            for datapoint in response['Datapoints']:
+            # Datapoints come back unordered; sort them so the newest is last
+            # and survives deduplication in main()
+            for datapoint in sorted(response['Datapoints'], key=itemgetter('Timestamp')):
                 metrics.append(BillingMetric(
                     name='aws_billing_estimated_charges_total_usd',
                     value=datapoint['Maximum'],
@@ -156,49 +255,83 @@ class AWSBillingCollector:
                 ))
             
             # Get estimated charges by service
-            services_response = self.cloudwatch.list_metrics(
+            list_billing_metrics = lambda: self.cloudwatch.list_metrics(
                 Namespace='AWS/Billing',
                 MetricName='EstimatedCharges'
-            )
+            )['Metrics']
+            if self.account_id:
+                billing_metrics = self._cached_call(
+                    f'cloudwatch_billing_metrics:{self.account_id}:{self.region}',
+                    self.metadata_cache_ttl,
+                    list_billing_metrics
+                )
+            else:
+                # Without an account ID the cache can't tell accounts apart
+                billing_metrics = list_billing_metrics()
             
             services = set()
-            for metric in services_response['Metrics']:
+            for metric in billing_metrics:
                 for dimension in metric['Dimensions']:
                     if dimension['Name'] == 'ServiceName':
                         services.add(dimension['Value'])
             
-            # Get metrics for each service
-            for service in services:
-                try:
-                    service_response = self.cloudwatch.get_metric_statistics(
-                        Namespace='AWS/Billing',
-                        MetricName='EstimatedCharges',
-                        Dimensions=[
-                            {'Name': 'Currency', 'Value': 'USD'},
-                            {'Name': 'ServiceName', 'Value': service}
-                        ],
-                        StartTime=datetime.datetime.now() - datetime.timedelta(days=1),
-                        EndTime=datetime.datetime.now(),
-                        Period=86400,
-                        Statistics=['Maximum']
-                    )
+            # Get metrics for all services in batched GetMetricData calls
+            end_time = datetime.datetime.now()
+            start_time = end_time - datetime.timedelta(days=1)
+            service_by_id = {f'm{i}': service for i, service in enumerate(sorted(services))}
+            queries = [
+                {
+                    'Id': query_id,
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': 'AWS/Billing',
+                            'MetricName': 'EstimatedCharges',
+                            'Dimensions': [
+                                {'Name': 'Currency', 'Value': 'USD'},
+                                {'Name': 'ServiceName', 'Value': service}
+                            ]
+                        },
+                        'Period': 86400,
+                        'Stat': 'Maximum'
+                    }
+                }
+                for query_id, service in service_by_id.items()
+            ]
+            
+            for i in range(0, len(queries), METRIC_DATA_QUERY_LIMIT):
+                request = {
+                    'MetricDataQueries': queries[i:i + METRIC_DATA_QUERY_LIMIT],
+                    'StartTime': start_time,
+                    'EndTime': end_time,
+                    # Oldest first, so the newest value is last and survives
+                    # deduplication in main()
+                    'ScanBy': 'TimestampAscending'
+                }
+                while True:
+                    data_response = self.cloudwatch.get_metric_data(**request)
                     
-                    for datapoint in service_response['Datapoints']:
-                        metrics.append(BillingMetric(
-                            name='aws_billing_estimated_charges_by_service_usd',
-                            value=datapoint['Maximum'],
-                            labels={
-                                'service': service,
-                                'account_id': self.account_id,
-                                'currency': 'USD'
-                            },
-                            timestamp=current_time,
-                            help_text='AWS estimated charges by service in USD'
-                        ))
+                    for result in data_response['MetricDataResults']:
+                        service = service_by_id[result['Id']]
+                        if result.get('StatusCode') not in ('Complete', 'PartialData'):
+                            logger.warning(f"Failed to get metrics for service {service}: {result.get('StatusCode')}")
+                            continue
                         
-                except Exception as e:
-                    logger.warning(f"Failed to get metrics for service {service}: {str(e)}")
-                    continue
+                        for value in result['Values']:
+                            metrics.append(BillingMetric(
+                                name='aws_billing_estimated_charges_by_service_usd',
+                                value=value,
+                                labels={
+                                    'service': service,
+                                    'account_id': self.account_id,
+                                    'currency': 'USD'
+                                },
+                                timestamp=current_time,
+                                help_text='AWS estimated charges by service in USD'
+                            ))
+                    
+                    if not data_response.get('NextToken'):
+                        break
+                    request['NextToken'] = data_response['NextToken']
             
             logger.info(f"Collected {len(metrics)} CloudWatch billing metrics")
             
@@ -212,28 +345,44 @@ class AWSBillingCollector:
         metrics = []
         
         try:
-            budgets_client = boto3.client('budgets', region_name=self.region)
-            
             # List all budgets
-            response = budgets_client.describe_budgets(
-                AccountId=self.account_id
+            budgets = self._cached_call(
+                f'budgets:{self.account_id}',
+                self.metadata_cache_ttl,
+                lambda: self.budgets_client.describe_budgets(
+                    AccountId=self.account_id
+                ).get('Budgets', [])
             )
             
             current_time = datetime.datetime.now()
             
-            for budget in response.get('Budgets', []):
+            # Fetch budget performance for all budgets concurrently
+            end_time = datetime.datetime.now()
+            time_period = {
+                'Start': end_time - datetime.timedelta(days=30),
+                'End': end_time
+            }
+            
+            with ThreadPoolExecutor(max_workers=BUDGET_CONCURRENCY) as executor:
+                futures = {
+                    executor.submit(
+                        self.budgets_client.describe_budget_performance_history,
+                        AccountId=self.account_id,
+                        BudgetName=budget['BudgetName'],
+                        TimePeriod=time_period
+                    ): budget
+                    for budget in budgets
+                }
+            
+            for future, budget in futures.items():
                 budget_name = budget['BudgetName']
                 budget_limit = float(budget['BudgetLimit']['Amount'])
                 
-                # Get budget performance
-                perf_response = budgets_client.describe_budget_performance_history(
-                    AccountId=self.account_id,
-                    BudgetName=budget_name,
-                    TimePeriod={
-                        'Start': datetime.datetime.now() - datetime.timedelta(days=30),
-                        'End': datetime.datetime.now()
-                    }
-                )
+                try:
+                    perf_response = future.result()
+                except Exception as e:
+                    logger.warning(f"Failed to get performance for budget {budget_name}: {str(e)}")
+                    continue
                 
                 if perf_response.get('BudgetPerformanceHistory'):
                     latest_performance = perf_response['BudgetPerformanceHistory'][-1]
@@ -305,14 +454,22 @@ class AWSBillingCollector:
         try:
             os.makedirs(os.path.dirname(filename), exist_ok=True)
             
-            metrics_data = []
-            for metric in metrics:
-                metric_dict = asdict(metric)
-                metric_dict['timestamp'] = metric.timestamp.isoformat()
-                metrics_data.append(metric_dict)
+            # Keep each metric name contiguous so the pusher can stream the file
+            metrics = sorted(metrics, key=lambda metric: metric.name)
             
-            with open(filename, 'w') as f:
-                json.dump(metrics_data, f, indent=2, default=str)
+            if orjson is not None:
+                # orjson serializes dataclasses and datetimes natively
+                with open(filename, 'wb') as f:
+                    f.write(orjson.dumps(metrics, option=orjson.OPT_INDENT_2))
+            else:
+                metrics_data = []
+                for metric in metrics:
+                    metric_dict = asdict(metric)
+                    metric_dict['timestamp'] = metric.timestamp.isoformat()
+                    metrics_data.append(metric_dict)
+                
+                with open(filename, 'w') as f:
+                    json.dump(metrics_data, f, indent=2, default=str)
             
             logger.info(f"Saved {len(metrics)} metrics to {filename}")
             
@@ -321,37 +478,56 @@ class AWSBillingCollector:
 
 def main():
     """Main execution function"""
+    parser = argparse.ArgumentParser(description='Collect AWS billing data')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Ignore cached AWS metadata and fetch it again')
+    args = parser.parse_args()
+    
     try:
         # Create necessary directories
         os.makedirs('data', exist_ok=True)
         os.makedirs('logs', exist_ok=True)
         
+        if args.refresh:
+            clear_metadata_cache()
+        
         logger.info("Starting AWS billing data collection")
         
         # Initialize collector
         collector = AWSBillingCollector()
         
-        # Collect all metrics
-        all_metrics = []
-        
-        # Get current costs
-        logger.info("Collecting current costs...")
-        cost_metrics = collector.get_current_costs(days_back=2)
-        all_metrics.extend(cost_metrics)
-        
-        # Get CloudWatch billing metrics
-        logger.info("Collecting CloudWatch billing metrics...")
-        cw_metrics = collector.get_cloudwatch_billing_metrics()
-        all_metrics.extend(cw_metrics)
+        # Collect all metrics; the phases are independent network-bound calls,
+        # so run them concurrently
+        phases = [
+            ("current costs", lambda: collector.get_current_costs(days_back=2)),
+            ("CloudWatch billing metrics", collector.get_cloudwatch_billing_metrics),
+        ]
         
         # Get budget metrics (only if account ID is provided)
         if collector.account_id:
-            logger.info("Collecting budget metrics...")
-            budget_metrics = collector.get_budget_metrics()
-            all_metrics.extend(budget_metrics)
+            phases.append(("budget metrics", collector.get_budget_metrics))
         else:
             logger.warning("AWS_ACCOUNT_ID not provided, skipping budget metrics")
         
+        all_metrics = []
+        with ThreadPoolExecutor(max_workers=len(phases)) as executor:
+            futures = []
+            for phase_name, collect in phases:
+                logger.info(f"Collecting {phase_name}...")
+                futures.append(executor.submit(collect))
+            
+            for future in futures:
+                all_metrics.extend(future.result())
+        
+        # Drop duplicate series, keeping the last (newest) value of each;
+        # Pushgateway would keep only the last one anyway
+        unique_metrics = {}
+        for metric in all_metrics:
+            unique_metrics[(metric.name, frozenset(metric.labels.items()))] = metric
+        if len(unique_metrics) < len(all_metrics):
+            logger.info(f"Dropped {len(all_metrics) - len(unique_metrics)} duplicate metrics")
+        all_metrics = list(unique_metrics.values())
+        
         # Save metrics to file
         collector.save_metrics_to_file(all_metrics)
         
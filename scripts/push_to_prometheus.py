@@ -6,13 +6,36 @@ This script pushes the collected AWS billing metrics to Prometheus via the Pushg
 """
 
 import os
+import re
+import gzip
+import string
 import json
+import functools
+import itertools
 import logging
 import requests
 import datetime
-from typing import Dict, List, Any
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from operator import itemgetter
+from typing import Dict, List, Any, Iterable, Iterator, Tuple
 from urllib.parse import urljoin
-import time
+
+try:
+    import orjson  # Optional: much faster JSON parsing
+except ImportError:
+    orjson = None
+
+try:
+    # Optional: official exposition formatting and push client
+    from prometheus_client import CollectorRegistry, Gauge, pushadd_to_gateway
+except ImportError:
+    CollectorRegistry = None
+
+try:
+    import ijson  # Optional: streams the metrics file instead of loading it whole
+except ImportError:
+    ijson = None
 
 # Configure logging
 logging.basicConfig(
@@ -25,54 +48,107 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Characters not allowed in Prometheus metric and label names
+_METRIC_NAME_RE = re.compile(r'[^a-zA-Z0-9_:]')
+_LABEL_NAME_RE = re.compile(r'[^a-zA-Z0-9_]')
+
+# Characters allowed in Prometheus metric and label names, for the fast path
+_VALID_METRIC_CHARS = frozenset(string.ascii_letters + string.digits + '_:')
+_VALID_LABEL_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+
+# Escapes backslashes and quotes in label values
+_LABEL_VALUE_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"'})
+
+# Payloads larger than this are gzip-compressed before pushing
+GZIP_MIN_BYTES = 16 * 1024
+
+# Target number of metric lines per push request
+PUSH_CHUNK_SIZE = 1000
+
+# Outcomes of a single push request. Only a rejected push points at bad
+# metrics; a failed one means the gateway could not be reached or errored
+PUSH_OK = 'ok'
+PUSH_REJECTED = 'rejected'
+PUSH_FAILED = 'failed'
+
+def _push_outcome(status_code: int) -> str:
+    """Classify a Pushgateway response status"""
+    if status_code == 200:
+        return PUSH_OK
+    # 429 is the gateway shedding load, not a complaint about the metrics
+    if 400 <= status_code < 500 and status_code != 429:
+        return PUSH_REJECTED
+    return PUSH_FAILED
+
+class _PushResponseError(IOError):
+    """Raised by the prometheus_client handler for an error response"""
+    
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
 class PrometheusMetricFormatter:
     """Formats metrics for Prometheus Pushgateway"""
     
     @staticmethod
     def sanitize_metric_name(name: str) -> str:
         """Sanitize metric name for Prometheus"""
-        # Replace invalid characters with underscores
-        import re
-        return re.sub(r'[^a-zA-Z0-9_:]', '_', name)
+        # Most names are already valid; only run the substitution when needed
+        if _VALID_METRIC_CHARS.issuperset(name):
+            return name
+        return _METRIC_NAME_RE.sub('_', name)
     
     @staticmethod
     def sanitize_label_name(name: str) -> str:
         """Sanitize label name for Prometheus"""
-        import re
-        return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        if _VALID_LABEL_CHARS.issuperset(name):
+            return name
+        return _LABEL_NAME_RE.sub('_', name)
     
     @staticmethod
     def sanitize_label_value(value: str) -> str:
         """Sanitize label value for Prometheus"""
         # Escape quotes and backslashes
-        return str(value).replace('\\', '\\\\').replace('"', '\\"')
+        return str(value).translate(_LABEL_VALUE_ESCAPES)
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _format_labels(label_items: Tuple[Tuple[str, Any], ...]) -> str:
+        """Format label pairs as '{name="value",...}'; cached since label sets repeat across metrics"""
+        labels_str = ','.join(
+            f'{PrometheusMetricFormatter.sanitize_label_name(label_name)}='
+            f'"{PrometheusMetricFormatter.sanitize_label_value(label_value)}"'
+            for label_name, label_value in label_items
+        )
+        return '{' + labels_str + '}' if labels_str else ''
+    
+    @staticmethod
+    def _format(name: str, labels_str: str, value: Any) -> str:
+        """Format a sample line from an already sanitized name and label string"""
+        return f'{name}{labels_str} {value}'
+    
+    @staticmethod
+    def _format_metric_line(metric_data: Dict[str, Any]) -> str:
+        """Format the sample line of a single metric, without HELP/TYPE"""
+        return PrometheusMetricFormatter._format(
+            PrometheusMetricFormatter.sanitize_metric_name(metric_data['name']),
+            PrometheusMetricFormatter._format_labels(tuple(metric_data.get('labels', {}).items())),
+            metric_data['value']
+        )
     
     @staticmethod
     def format_metric_for_pushgateway(metric_data: Dict[str, Any]) -> str:
         """Format a single metric for Pushgateway"""
         name = PrometheusMetricFormatter.sanitize_metric_name(metric_data['name'])
-        value = metric_data['value']
-        labels = metric_data.get('labels', {})
         help_text = metric_data.get('help_text', '')
         
-        # Build labels string
-        label_pairs = []
-        for label_name, label_value in labels.items():
-            clean_name = PrometheusMetricFormatter.sanitize_label_name(label_name)
-            clean_value = PrometheusMetricFormatter.sanitize_label_value(label_value)
-            label_pairs.append(f'{clean_name}="{clean_value}"')
-        
-        labels_str = ','.join(label_pairs)
-        if labels_str:
-            labels_str = '{' + labels_str + '}'
-        
         # Format the metric
         lines = []
         if help_text:
             lines.append(f'# HELP {name} {help_text}')
             lines.append(f'# TYPE {name} gauge')
         
-        lines.append(f'{name}{labels_str} {value}')
+        lines.append(PrometheusMetricFormatter._format_metric_line(metric_data))
         
         return '\n'.join(lines)
 
@@ -84,49 +160,170 @@ class PrometheusPusher:
         self.job_name = job_name
         self.session = requests.Session()
         
+        # Number of metrics read by the most recent push
+        self.last_push_total = 0
+        
+        # Pool keep-alive connections across pushes and retry transient
+        # Pushgateway failures with exponential backoff
+        retry = Retry(
+            total=5,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['POST', 'PUT', 'DELETE', 'GET'],
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+        
         # Set reasonable timeouts
         self.session.timeout = (10, 30)  # (connect, read) timeout
         
         logger.info(f"Initialized Prometheus pusher for {pushgateway_url}, job: {job_name}")
     
-    def push_metrics(self, metrics_data: List[Dict[str, Any]], instance: str = None) -> bool:
-        """Push metrics to Pushgateway"""
-        if not metrics_data:
-            logger.warning("No metrics to push")
-            return True
+    @staticmethod
+    def _group_metrics(metrics_data: List[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+        """Group metrics by name, preserving first-seen order"""
+        grouped_metrics = {}
+        for metric in metrics_data:
+            metric_name = metric['name']
+            if metric_name not in grouped_metrics:
+                grouped_metrics[metric_name] = []
+            grouped_metrics[metric_name].append(metric)
+        return grouped_metrics
+    
+    def _iter_groups(self, metrics_data: Iterable[Dict[str, Any]]) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+        """Yield (name, metrics) groups
         
-        try:
-            # Group metrics by name for better organization
-            grouped_metrics = {}
-            for metric in metrics_data:
-                metric_name = metric['name']
-                if metric_name not in grouped_metrics:
-                    grouped_metrics[metric_name] = []
-                grouped_metrics[metric_name].append(metric)
-            
-            # Format all metrics
-            formatted_metrics = []
-            for metric_name, metrics_list in grouped_metrics.items():
-                # Add HELP and TYPE only once per metric name
-                if metrics_list:
-                    first_metric = metrics_list[0]
-                    help_text = first_metric.get('help_text', '')
-                    if help_text:
-                        formatted_metrics.append(f'# HELP {metric_name} {help_text}')
-                        formatted_metrics.append(f'# TYPE {metric_name} gauge')
-                
-                # Add all metric instances
-                for metric in metrics_list:
-                    metric_line = PrometheusMetricFormatter.format_metric_for_pushgateway(metric)
-                    # Remove HELP and TYPE lines as we added them above
-                    lines = metric_line.split('\n')
-                    for line in lines:
-                        if not line.startswith('#'):
-                            formatted_metrics.append(line)
-            
-            # Join all metrics
-            metrics_payload = '\n'.join(formatted_metrics)
+        Lists are grouped in memory. Other iterables are streamed and must
+        yield each metric name contiguously, as save_metrics_to_file writes them.
+        """
+        if isinstance(metrics_data, list):
+            yield from self._group_metrics(metrics_data).items()
+            return
+        
+        seen = set()
+        for metric_name, rows in itertools.groupby(metrics_data, key=itemgetter('name')):
+            if metric_name in seen:
+                logger.warning(f"Metrics for {metric_name} are not contiguous, earlier series may be replaced")
+            seen.add(metric_name)
+            yield metric_name, list(rows)
+    
+    def _iter_chunks(self, metrics_data: Iterable[Dict[str, Any]],
+                     chunk_size: int) -> Iterator[Dict[str, List[Dict[str, Any]]]]:
+        """Pack whole metric groups into chunks of roughly chunk_size lines
+        
+        A POST replaces every series of the metric names it contains, so chunks
+        are only ever split between metric names, never within one.
+        """
+        current, current_size = {}, 0
+        for metric_name, metrics_list in self._iter_groups(metrics_data):
+            if current and current_size + len(metrics_list) > chunk_size:
+                yield current
+                current, current_size = {}, 0
+            current.setdefault(metric_name, []).extend(metrics_list)
+            current_size += len(metrics_list)
+        if current:
+            yield current
+    
+    @staticmethod
+    def _build_payload(grouped_metrics: Dict[str, List[Dict[str, Any]]]) -> bytearray:
+        """Format grouped metrics into a UTF-8 exposition payload"""
+        # HELP and TYPE are written only once per metric name
+        payload = bytearray()
+        emit = payload.extend
+        format_labels = PrometheusMetricFormatter._format_labels
+        format_line = PrometheusMetricFormatter._format
+        for metric_name, metrics_list in grouped_metrics.items():
+            name = PrometheusMetricFormatter.sanitize_metric_name(metric_name)
+            help_text = metrics_list[0].get('help_text', '')
+            if help_text:
+                emit(f'# HELP {name} {help_text}\n# TYPE {name} gauge\n'.encode('utf-8'))
             
+            for metric in metrics_list:
+                labels_str = format_labels(tuple(metric.get('labels', {}).items()))
+                emit(format_line(name, labels_str, metric['value']).encode('utf-8'))
+                emit(b'\n')
+        return payload
+    
+    @staticmethod
+    def _build_registry(grouped_metrics: Dict[str, List[Dict[str, Any]]]) -> 'CollectorRegistry':
+        """Load grouped metrics into a prometheus_client registry"""
+        registry = CollectorRegistry()
+        for metric_name, metrics_list in grouped_metrics.items():
+            label_names = [
+                PrometheusMetricFormatter.sanitize_label_name(label_name)
+                for label_name in metrics_list[0].get('labels', {})
+            ]
+            gauge = Gauge(
+                PrometheusMetricFormatter.sanitize_metric_name(metric_name),
+                metrics_list[0].get('help_text', ''),
+                label_names,
+                registry=registry
+            )
+            for metric in metrics_list:
+                labels = {
+                    PrometheusMetricFormatter.sanitize_label_name(label_name): str(label_value)
+                    for label_name, label_value in metric.get('labels', {}).items()
+                }
+                if labels:
+                    gauge.labels(**labels).set(float(metric['value']))
+                else:
+                    gauge.set(float(metric['value']))
+        return registry
+    
+    def _session_handler(self, url: str, method: str, timeout: float, headers: List[Tuple[str, str]], data: bytes):
+        """prometheus_client push handler that reuses the pooled, retrying session"""
+        def handle():
+            response = self.session.request(method, url, data=data, headers=dict(headers), timeout=timeout)
+            if response.status_code >= 400:
+                raise _PushResponseError(f"Status: {response.status_code}, Response: {response.text}",
+                                         response.status_code)
+        return handle
+    
+    def _push_registry(self, registry: 'CollectorRegistry', instance: str = None) -> str:
+        """Push a prometheus_client registry to Pushgateway, returning a PUSH_* outcome"""
+        try:
+            pushadd_to_gateway(
+                self.pushgateway_url,
+                job=self.job_name,
+                registry=registry,
+                grouping_key={'instance': instance} if instance else None,
+                timeout=30,
+                handler=self._session_handler
+            )
+            return PUSH_OK
+        except _PushResponseError as e:
+            logger.error(f"Failed to push metrics: {str(e)}")
+            return _push_outcome(e.status_code)
+        except Exception as e:
+            logger.error(f"Failed to push metrics: {str(e)}")
+            return PUSH_FAILED
+    
+    def _push_groups(self, grouped_metrics: Dict[str, List[Dict[str, Any]]], instance: str = None) -> str:
+        """Push a chunk of metric groups, via prometheus_client when installed
+        
+        Returns a PUSH_* outcome; metrics that can't be formatted count as rejected.
+        """
+        if CollectorRegistry is not None:
+            try:
+                registry = self._build_registry(grouped_metrics)
+            except Exception as e:
+                logger.warning(f"prometheus_client rejected metrics, using built-in formatter: {str(e)}")
+            else:
+                return self._push_registry(registry, instance)
+        
+        try:
+            payload = self._build_payload(grouped_metrics)
+        except Exception as e:
+            logger.error(f"Error formatting metrics {', '.join(grouped_metrics)}: {str(e)}")
+            return PUSH_REJECTED
+        return self._push_chunk(payload, instance)
+    
+    def _push_chunk(self, payload: bytes, instance: str = None) -> str:
+        """POST an exposition payload to Pushgateway, returning a PUSH_* outcome"""
+        try:
             # Build URL for pushgateway
             url_parts = [self.pushgateway_url, 'metrics', 'job', self.job_name]
             if instance:
@@ -135,55 +332,102 @@ class PrometheusPusher:
             push_url = '/'.join(url_parts)
             
             # Log the payload for debugging (truncated)
-            payload_preview = metrics_payload[:500] + '...' if len(metrics_payload) > 500 else metrics_payload
+            payload_preview = payload[:500].decode('utf-8', 'replace') + ('...' if len(payload) > 500 else '')
             logger.debug(f"Pushing metrics to {push_url}:\n{payload_preview}")
             
+            # Compress large payloads; exposition text is highly repetitive
+            headers = {'Content-Type': 'text/plain; version=0.0.4'}
+            body = bytes(payload)
+            if len(body) > GZIP_MIN_BYTES:
+                body = gzip.compress(body, compresslevel=1)
+                headers['Content-Encoding'] = 'gzip'
+            
             # Push to Pushgateway
             response = self.session.post(
                 push_url,
-                data=metrics_payload,
-                headers={'Content-Type': 'text/plain; version=0.0.4'},
+                data=body,
+                headers=headers,
                 timeout=30
             )
             
-            if response.status_code == 200:
-                logger.info(f"Successfully pushed {len(metrics_data)} metrics to Prometheus")
-                return True
-            else:
+            outcome = _push_outcome(response.status_code)
+            if outcome != PUSH_OK:
                 logger.error(f"Failed to push metrics. Status: {response.status_code}, Response: {response.text}")
-                return False
+            return outcome
                 
         except requests.exceptions.Timeout:
             logger.error("Timeout while pushing metrics to Prometheus")
-            return False
+            return PUSH_FAILED
         except requests.exceptions.ConnectionError as e:
             logger.error(f"Connection error while pushing metrics: {str(e)}")
-            return False
+            return PUSH_FAILED
         except Exception as e:
             logger.error(f"Unexpected error while pushing metrics: {str(e)}")
+            return PUSH_FAILED
+    
+    def push_metrics(self, metrics_data: Iterable[Dict[str, Any]], instance: str = None,
+                     chunk_size: int = PUSH_CHUNK_SIZE) -> bool:
+        """Push metrics to Pushgateway in requests of roughly chunk_size lines
+        
+        metrics_data may be a list or a stream such as iter_metrics_from_file().
+        """
+        self.last_push_total = 0
+        
+        try:
+            for chunk in self._iter_chunks(metrics_data, chunk_size):
+                self.last_push_total += sum(len(metrics_list) for metrics_list in chunk.values())
+                if self._push_groups(chunk, instance) != PUSH_OK:
+                    return False
+        except Exception as e:
+            logger.error(f"Unexpected error while reading metrics: {str(e)}")
             return False
+        
+        if not self.last_push_total:
+            logger.warning("No metrics to push")
+            return True
+        
+        logger.info(f"Successfully pushed {self.last_push_total} metrics to Prometheus")
+        return True
     
-    def push_metrics_individually(self, metrics_data: List[Dict[str, Any]], instance: str = None) -> bool:
-        """Push metrics individually (fallback method)"""
+    def push_metrics_in_chunks(self, metrics_data: Iterable[Dict[str, Any]], instance: str = None,
+                               chunk_size: int = PUSH_CHUNK_SIZE) -> bool:
+        """Push metrics in chunks, splitting rejected chunks to isolate bad metrics (fallback method)
+        
+        Gives up at the first push that fails for any other reason, such as an
+        unreachable gateway, since splitting can't help with that.
+        """
+        self.last_push_total = 0
         success_count = 0
         
-        for i, metric in enumerate(metrics_data):
-            try:
-                success = self.push_metrics([metric], instance)
-                if success:
-                    success_count += 1
-                else:
-                    logger.warning(f"Failed to push metric {i+1}/{len(metrics_data)}: {metric.get('name', 'unknown')}")
+        try:
+            for chunk in self._iter_chunks(metrics_data, chunk_size):
+                self.last_push_total += sum(len(metrics_list) for metrics_list in chunk.values())
                 
-                # Add small delay to avoid overwhelming the pushgateway
-                if i > 0 and i % 10 == 0:
-                    time.sleep(0.1)
+                pending = [chunk]
+                while pending:
+                    chunk = pending.pop()
+                    count = sum(len(metrics_list) for metrics_list in chunk.values())
                     
-            except Exception as e:
-                logger.error(f"Error pushing individual metric {i+1}: {str(e)}")
-                continue
+                    outcome = self._push_groups(chunk, instance)
+                    if outcome == PUSH_OK:
+                        success_count += count
+                    elif outcome == PUSH_FAILED:
+                        logger.error(f"Pushgateway unavailable, aborting chunked push after "
+                                     f"{success_count}/{self.last_push_total} metrics")
+                        return False
+                    elif len(chunk) > 1:
+                        # Split in half and retry each side to localize the failure
+                        names = list(chunk)
+                        middle = len(names) // 2
+                        pending.append({name: chunk[name] for name in names[middle:]})
+                        pending.append({name: chunk[name] for name in names[:middle]})
+                    else:
+                        logger.warning(f"Failed to push {count} metrics for {next(iter(chunk))}")
+        except Exception as e:
+            logger.error(f"Unexpected error while reading metrics: {str(e)}")
+            return False
         
-        logger.info(f"Successfully pushed {success_count}/{len(metrics_data)} metrics individually")
+        logger.info(f"Successfully pushed {success_count}/{self.last_push_total} metrics in chunks")
         return success_count > 0
     
     def delete_metrics(self, instance: str = None) -> bool:
@@ -228,8 +472,12 @@ class PrometheusPusher:
 def load_metrics_from_file(filename: str = 'data/billing_metrics.json') -> List[Dict[str, Any]]:
     """Load metrics from JSON file"""
     try:
-        with open(filename, 'r') as f:
-            metrics_data = json.load(f)
+        if orjson is not None:
+            with open(filename, 'rb') as f:
+                metrics_data = orjson.loads(f.read())
+        else:
+            with open(filename, 'r') as f:
+                metrics_data = json.load(f)
         
         logger.info(f"Loaded {len(metrics_data)} metrics from {filename}")
         return metrics_data
@@ -244,6 +492,27 @@ def load_metrics_from_file(filename: str = 'data/billing_metrics.json') -> List[
         logger.error(f"Error loading metrics file: {str(e)}")
         return []
 
+def iter_metrics_from_file(filename: str = 'data/billing_metrics.json') -> Iterator[Dict[str, Any]]:
+    """Stream metrics from JSON file without loading it all into memory"""
+    if ijson is None:
+        yield from load_metrics_from_file(filename)
+        return
+    
+    try:
+        with open(filename, 'rb') as f:
+            yield from ijson.items(f, 'item', use_float=True)
+            
+    except FileNotFoundError:
+        logger.error(f"Metrics file not found: {filename}")
+    except ijson.JSONError as e:
+        # Re-raise so a truncated file fails the push instead of looking
+        # like a normal end of stream
+        logger.error(f"Invalid JSON in metrics file: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error reading metrics file: {str(e)}")
+        raise
+
 def main():
     """Main execution function"""
     try:
@@ -261,9 +530,10 @@ def main():
             logger.error("PROMETHEUS_PUSHGATEWAY_URL environment variable is required")
             return False
         
-        # Load metrics
-        metrics_data = load_metrics_from_file()
-        if not metrics_data:
+        # Stream metrics from file, making sure there is something to push
+        metrics_stream = iter_metrics_from_file()
+        first_metric = next(metrics_stream, None)
+        if first_metric is None:
             logger.error("No metrics to push")
             return False
         
@@ -274,14 +544,14 @@ def main():
         if not pusher.health_check():
             logger.warning("Pushgateway health check failed, but continuing...")
         
-        # Try to push all metrics at once first
-        logger.info(f"Attempting to push {len(metrics_data)} metrics to Prometheus...")
-        success = pusher.push_metrics(metrics_data, instance_name)
+        # Try to push all metrics in full-size batches first
+        logger.info("Attempting to push metrics to Prometheus...")
+        success = pusher.push_metrics(itertools.chain([first_metric], metrics_stream), instance_name)
         
-        # If batch push fails, try individual pushes
+        # If batch push fails, re-read the file and isolate the failing metrics
         if not success:
-            logger.warning("Batch push failed, trying individual pushes...")
-            success = pusher.push_metrics_individually(metrics_data, instance_name)
+            logger.warning("Batch push failed, trying chunked pushes...")
+            success = pusher.push_metrics_in_chunks(iter_metrics_from_file(), instance_name)
         
         if success:
             logger.info("Successfully completed metrics push to Prometheus")
@@ -289,7 +559,7 @@ def main():
             # Save a summary
             summary = {
                 'timestamp': datetime.datetime.now().isoformat(),
-                'total_metrics': len(metrics_data),
+                'total_metrics': pusher.last_push_total,
                 'pushgateway_url': pushgateway_url,
                 'job_name': job_name,
                 'instance_name': instance_name,
@@ -5,45 +5,126 @@ Test script for AWS Billing Data Collector
 This script validates the setup and configuration.
 """
 
+import io
+import argparse
 import os
 import sys
 import json
-import boto3
-import requests
-from botocore.exceptions import ClientError, NoCredentialsError
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Sample metric pushed by the Pushgateway check
+_TEST_METRIC = (
+    b"# HELP test_metric A test metric\n"
+    b"# TYPE test_metric gauge\n"
+    b'test_metric{job="test"} 1.0\n'
+)
+_TEST_HEADERS = {'Content-Type': 'text/plain; version=0.0.4'}
+
+# Environment variables checked by test_environment_variables
+_REQUIRED_VARS = (
+    'AWS_REGION',
+    'PROMETHEUS_PUSHGATEWAY_URL'
+)
+_OPTIONAL_VARS = (
+    'AWS_ACCESS_KEY_ID',
+    'AWS_SECRET_ACCESS_KEY',
+    'AWS_ACCOUNT_ID',
+    'PROMETHEUS_JOB_NAME'
+)
+
+# Variables whose values are masked, and the fixed mask, which also hides
+# the length of the value
+_SENSITIVE_VARS = frozenset(
+    var for var in _REQUIRED_VARS + _OPTIONAL_VARS if 'SECRET' in var or 'KEY' in var
+)
+_MASK = '********'
+
+# Output buffer of the test running on the current thread, if any
+_test_output = threading.local()
+
+class _ThreadLocalStdout:
+    """Sends writes to the current thread's test buffer, or to the real stdout"""
+    
+    def __init__(self, stream):
+        self._stream = stream
+    
+    def write(self, text):
+        return getattr(_test_output, 'buffer', self._stream).write(text)
+    
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+def _run_test(test_name, test_func):
+    """Run a test, returning its result and everything it printed"""
+    _test_output.buffer = io.StringIO()
+    try:
+        try:
+            result = test_func()
+        except Exception as e:
+            print(f"❌ {test_name} test failed with error: {e}")
+            result = False
+        return result, _test_output.buffer.getvalue()
+    finally:
+        del _test_output.buffer
 
 def test_aws_connection():
     """Test AWS connection and permissions"""
     print("🔍 Testing AWS connection...")
     
+    # Imported here so checks that don't need AWS skip loading boto3
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError, NoCredentialsError
+    
     try:
+        # One session shares credential resolution and service models across clients
+        session = boto3.session.Session(region_name=os.getenv('AWS_REGION', 'us-east-1'))
+        
+        # Keep the connection alive between probes and fail fast on a bad endpoint
+        config = Config(
+            tcp_keepalive=True,
+            connect_timeout=3,
+            read_timeout=5,
+            retries={'max_attempts': 1},
+            max_pool_connections=50
+        )
+        
         # Test basic AWS connection
-        sts = boto3.client('sts')
+        sts = session.client('sts', config=config)
         identity = sts.get_caller_identity()
         print(f"✅ AWS connection successful")
         print(f"   Account ID: {identity.get('Account', 'N/A')}")
         print(f"   User/Role: {identity.get('Arn', 'N/A')}")
         
-        # Test CloudWatch access
-        cloudwatch = boto3.client('cloudwatch', region_name='us-east-1')
-        response = cloudwatch.list_metrics(
-            Namespace='AWS/Billing',
-            MetricName='EstimatedCharges',
-            MaxRecords=1
-        )
-        print(f"✅ CloudWatch Billing access confirmed")
-        
-        # Test Cost Explorer access
-        ce = boto3.client('ce', region_name='us-east-1')
-        ce.get_cost_and_usage(
-            TimePeriod={
-                'Start': '2024-01-01',
-                'End': '2024-01-02'
-            },
-            Granularity='DAILY',
-            Metrics=['BlendedCost']
-        )
-        print(f"✅ Cost Explorer access confirmed")
+        # Test CloudWatch and Cost Explorer access concurrently; neither depends
+        # on the other
+        cloudwatch = session.client('cloudwatch', config=config)
+        ce = session.client('ce', config=config)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            cloudwatch_probe = executor.submit(
+                cloudwatch.list_metrics,
+                Namespace='AWS/Billing',
+                MetricName='EstimatedCharges',
+                MaxRecords=1
+            )
+            # Probe GetCostAndUsage itself, since that is the action the
+            # collector needs; one ungrouped day keeps the query small
+            ce_probe = executor.submit(
+                ce.get_cost_and_usage,
+                TimePeriod={
+                    'Start': '2024-01-01',
+                    'End': '2024-01-02'
+                },
+                Granularity='DAILY',
+                Metrics=['BlendedCost']
+            )
+            
+            cloudwatch_probe.result()
+            print(f"✅ CloudWatch Billing access confirmed")
+            
+            ce_probe.result()
+            print(f"✅ Cost Explorer access confirmed")
         
         return True
         
@@ -72,6 +153,14 @@ def test_aws_connection():
         print(f"❌ Unexpected AWS error: {e}")
         return False
 
+def _report_cleanup(future, push_url):
+    """Warn on stderr if deleting the test metric failed"""
+    error = future.exception()
+    if error is None and future.result().status_code != 202:
+        error = f"status {future.result().status_code}"
+    if error is not None:
+        print(f"⚠️  Failed to delete test metric at {push_url}: {error}", file=sys.stderr)
+
 def test_prometheus_pushgateway():
     """Test Prometheus Pushgateway connection"""
     print("\n🔍 Testing Prometheus Pushgateway connection...")
@@ -80,42 +169,59 @@ def test_prometheus_pushgateway():
     if not pushgateway_url:
         print("❌ PROMETHEUS_PUSHGATEWAY_URL not set")
         return False
+    base = pushgateway_url.rstrip('/')
+    
+    import requests
+    from requests.adapters import HTTPAdapter
+    
+    # Reuse one pooled connection for the health, push and cleanup requests
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
     
     try:
-        # Test health endpoint
-        health_url = f"{pushgateway_url.rstrip('/')}/-/healthy"
-        response = requests.get(health_url, timeout=5)
+        # The push doesn't depend on the health check, so send both at once.
+        # HEAD is enough for the health check; fall back to GET on gateways
+        # that don't allow it
+        health_url = f"{base}/-/healthy"
+        push_url = f"{base}/metrics/job/test"
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            health_probe = executor.submit(session.head, health_url, timeout=5)
+            push_probe = executor.submit(
+                session.post,
+                push_url,
+                data=_TEST_METRIC,
+                headers=_TEST_HEADERS,
+                timeout=10
+            )
+            response = health_probe.result()
+            if response.status_code == 405:
+                response = session.get(health_url, timeout=5)
+            push_response = push_probe.result()
         
-        if response.status_code == 200:
+        healthy = response.status_code == 200
+        if healthy:
             print(f"✅ Pushgateway health check passed")
             print(f"   URL: {pushgateway_url}")
+        else:
+            print(f"❌ Pushgateway health check failed: {response.status_code}")
+        
+        pushed = push_response.status_code == 200
+        if pushed:
+            print("✅ Pushgateway metric push test successful")
             
-            # Test pushing a sample metric
-            test_metric = """# HELP test_metric A test metric
-# TYPE test_metric gauge
-test_metric{job="test"} 1.0
-"""
-            push_url = f"{pushgateway_url.rstrip('/')}/metrics/job/test"
-            push_response = requests.post(
-                push_url,
-                data=test_metric,
-                headers={'Content-Type': 'text/plain; version=0.0.4'},
-                timeout=10
+            # Clean up test metric in the background; the result doesn't depend
+            # on it, and the interpreter still waits for it before exiting
+            cleanup = ThreadPoolExecutor(max_workers=1)
+            cleanup.submit(session.delete, push_url, timeout=5).add_done_callback(
+                lambda future: _report_cleanup(future, push_url)
             )
-            
-            if push_response.status_code == 200:
-                print("✅ Pushgateway metric push test successful")
-                
-                # Clean up test metric
-                requests.delete(push_url, timeout=5)
-                return True
-            else:
-                print(f"❌ Pushgateway push test failed: {push_response.status_code}")
-                return False
-                
+            cleanup.shutdown(wait=False)
         else:
-            print(f"❌ Pushgateway health check failed: {response.status_code}")
-            return False
+            print(f"❌ Pushgateway push test failed: {push_response.status_code}")
+        
+        return healthy and pushed
             
     except requests.exceptions.ConnectionError:
         print(f"❌ Cannot connect to Pushgateway at {pushgateway_url}")
@@ -132,46 +238,31 @@ test_metric{job="test"} 1.0
 
 def test_environment_variables():
     """Test required environment variables"""
-    print("\n🔍 Checking environment variables...")
-    
-    required_vars = [
-        'AWS_REGION',
-        'PROMETHEUS_PUSHGATEWAY_URL'
-    ]
-    
-    optional_vars = [
-        'AWS_ACCESS_KEY_ID',
-        'AWS_SECRET_ACCESS_KEY',
-        'AWS_ACCOUNT_ID',
-        'PROMETHEUS_JOB_NAME'
-    ]
+    out = ["\n🔍 Checking environment variables..."]
     
     all_good = True
+    env = os.environ
     
-    for var in required_vars:
-        value = os.getenv(var)
-        if value:
-            print(f"✅ {var}: {value}")
-        else:
-            print(f"❌ {var}: Not set (required)")
-            all_good = False
-    
-    for var in optional_vars:
-        value = os.getenv(var)
+    for var in _REQUIRED_VARS + _OPTIONAL_VARS:
+        value = env.get(var)
         if value:
             # Hide sensitive values
-            if 'SECRET' in var or 'KEY' in var:
-                print(f"✅ {var}: {'*' * len(value)}")
+            if var in _SENSITIVE_VARS:
+                out.append(f"✅ {var}: {_MASK}")
             else:
-                print(f"✅ {var}: {value}")
+                out.append(f"✅ {var}: {value}")
+        elif var in _OPTIONAL_VARS:
+            out.append(f"⚠️  {var}: Not set (optional)")
         else:
-            print(f"⚠️  {var}: Not set (optional)")
+            out.append(f"❌ {var}: Not set (required)")
+            all_good = False
     
+    sys.stdout.write('\n'.join(out) + '\n')
     return all_good
 
 def test_file_structure():
     """Test file structure and permissions"""
-    print("\n🔍 Checking file structure...")
+    out = ["\n🔍 Checking file structure..."]
     
     required_files = [
         'scripts/collect_billing_data.py',
@@ -187,67 +278,138 @@ def test_file_structure():
     
     all_good = True
     
+    # List each parent directory once; DirEntry caches the file type, so this
+    # avoids a stat() call per path
+    files, dirs = set(), set()
+    for parent in {os.path.dirname(path) or '.' for path in required_files + required_dirs}:
+        try:
+            with os.scandir(parent) as entries:
+                for entry in entries:
+                    path = entry.name if parent == '.' else f"{parent}/{entry.name}"
+                    if entry.is_file():
+                        files.add(path)
+                    elif entry.is_dir():
+                        dirs.add(path)
+        except OSError:
+            continue
+    
     for file_path in required_files:
-        if os.path.isfile(file_path):
-            print(f"✅ {file_path}: Exists")
+        if file_path in files:
+            out.append(f"✅ {file_path}: Exists")
         else:
-            print(f"❌ {file_path}: Missing")
+            out.append(f"❌ {file_path}: Missing")
             all_good = False
     
+    # Only call makedirs for directories the scan didn't find; on an existing
+    # directory it costs a failed mkdir plus a stat
     for dir_path in required_dirs:
-        if os.path.isdir(dir_path):
-            print(f"✅ {dir_path}/: Exists")
+        if dir_path in dirs:
+            out.append(f"✅ {dir_path}/: Exists")
         else:
-            print(f"⚠️  {dir_path}/: Missing (will be created)")
+            out.append(f"⚠️  {dir_path}/: Missing (will be created)")
             try:
                 os.makedirs(dir_path, exist_ok=True)
-                print(f"✅ {dir_path}/: Created")
+                out.append(f"✅ {dir_path}/: Created")
             except Exception as e:
-                print(f"❌ {dir_path}/: Cannot create - {e}")
+                out.append(f"❌ {dir_path}/: Cannot create - {e}")
                 all_good = False
     
+    sys.stdout.write('\n'.join(out) + '\n')
     return all_good
 
+# Tests by the name used to select them on the command line, in run order
+ALL_TESTS = {
+    'env': ("Environment Variables", test_environment_variables),
+    'files': ("File Structure", test_file_structure),
+    'aws': ("AWS Connection", test_aws_connection),
+    'push': ("Prometheus Pushgateway", test_prometheus_pushgateway)
+}
+
+# Tests that need the required environment variables to pass
+NETWORK_TESTS = ('aws', 'push')
+
 def main():
     """Run all tests"""
+    parser = argparse.ArgumentParser(description='Validate the AWS Billing Data Collector setup')
+    parser.add_argument('--only', action='append', choices=ALL_TESTS,
+                        help='Run only this test; may be repeated')
+    parser.add_argument('--skip', action='append', choices=ALL_TESTS, default=[],
+                        help='Skip this test; may be repeated')
+    args = parser.parse_args()
+    
+    selected = [key for key in ALL_TESTS
+                if key in (args.only or ALL_TESTS) and key not in args.skip]
+    if not selected:
+        parser.error('no tests left to run')
+    
     print("🚀 AWS Billing Data Collector - Setup Validation")
     print("=" * 50)
     
-    tests = [
-        ("Environment Variables", test_environment_variables),
-        ("File Structure", test_file_structure),
-        ("AWS Connection", test_aws_connection),
-        ("Prometheus Pushgateway", test_prometheus_pushgateway)
-    ]
-    
     results = {}
+    env_ok = True
+    skipped = []
     
-    for test_name, test_func in tests:
-        try:
-            results[test_name] = test_func()
-        except Exception as e:
-            print(f"❌ {test_name} test failed with error: {e}")
+    # The tests are independent and mostly wait on the network, so run them
+    # concurrently and print each one's output in order once it finishes
+    stdout = sys.stdout
+    sys.stdout = _ThreadLocalStdout(stdout)
+    try:
+        # Check the environment first: without the required variables the
+        # network tests cannot pass, so skip them rather than load boto3
+        if 'env' in selected:
+            test_name, test_func = ALL_TESTS['env']
+            env_ok, output = _run_test(test_name, test_func)
+            stdout.write(output)
+            results[test_name] = env_ok
+        
+        tests = []
+        for key in selected:
+            if key == 'env':
+                continue
+            if key in NETWORK_TESTS and not env_ok:
+                skipped.append(ALL_TESTS[key][0])
+            else:
+                tests.append(ALL_TESTS[key])
+        
+        if tests:
+            with ThreadPoolExecutor(max_workers=len(tests)) as executor:
+                outcomes = executor.map(lambda test: _run_test(*test), tests)
+                for (test_name, _), (result, output) in zip(tests, outcomes):
+                    stdout.write(output)
+                    results[test_name] = result
+    finally:
+        sys.stdout = stdout
+    
+    if skipped:
+        print()
+        for test_name in skipped:
+            print(f"⏭️  {test_name}: Skipped (required environment variables missing)")
             results[test_name] = False
     
     # Summary
-    print("\n" + "=" * 50)
-    print("📊 Test Summary:")
+    out = ["\n" + "=" * 50, "📊 Test Summary:"]
     
     passed = sum(1 for result in results.values() if result)
     total = len(results)
     
-    for test_name, result in results.items():
-        status = "✅ PASS" if result else "❌ FAIL"
-        print(f"   {test_name}: {status}")
+    # Align the statuses in one column
+    width = max(map(len, results))
+    out.extend(
+        f"   {test_name:<{width}}: {'✅ PASS' if result else '❌ FAIL'}"
+        for test_name, result in results.items()
+    )
     
-    print(f"\nOverall: {passed}/{total} tests passed")
+    out.append(f"\nOverall: {passed}/{total} tests passed")
     
     if passed == total:
-        print("🎉 All tests passed! Your setup is ready.")
-        return 0
+        out.append("🎉 All tests passed! Your setup is ready.")
+        exit_code = 0
     else:
-        print("⚠️  Some tests failed. Please fix the issues above.")
-        return 1
+        out.append("⚠️  Some tests failed. Please fix the issues above.")
+        exit_code = 1
+    
+    sys.stdout.write('\n'.join(out) + '\n')
+    return exit_code
 
 if __name__ == "__main__":
     exit_code = main()